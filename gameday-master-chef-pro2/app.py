@@ -1,21 +1,56 @@
-import os, uuid, sqlite3
+import os, csv, uuid, hmac, zlib, hashlib, sqlite3, queue, threading
+from concurrent.futures import Future, TimeoutError as WriteTimeout
+import orjson
+import redis
+from flask_session import Session
 from sqlite3 import IntegrityError
-from flask import Flask, render_template, request, jsonify, g, Response, make_response, redirect, url_for, session
+from flask import Flask, render_template, request, Response, make_response, redirect, url_for, session, stream_with_context
 
 DATABASE = os.environ.get("DATABASE_URL", "ratings.db")
 SECRET_KEY = os.environ.get("SECRET_KEY", "replace-me")  # needed for admin session
+REDIS_URL = os.environ.get("REDIS_URL")  # optional; enables response caching
+CACHE_TTL = int(os.environ.get("CACHE_TTL", "5"))
+WRITE_TIMEOUT = float(os.environ.get("WRITE_TIMEOUT", "10"))  # seconds api_rate waits for its commit
 
-ENTRANTS = ["Javier","Lindsay","Yesenia","Bryan","Viviana","Bernie","Rogelio","Daniella","Colleen","Justin","Paige","Nic","Martha"]
+ENTRANTS = ("Javier","Lindsay","Yesenia","Bryan","Viviana","Bernie","Rogelio","Daniella","Colleen","Justin","Paige","Nic","Martha")
 
 app = Flask(__name__, static_folder="static", template_folder="templates")
 app.secret_key = SECRET_KEY
 
+cache = redis.Redis.from_url(REDIS_URL) if REDIS_URL else None
+if cache is not None:
+    # Keep admin sessions server-side in Redis instead of signed cookies
+    app.config.update(SESSION_TYPE="redis", SESSION_REDIS=cache)
+    Session(app)
+
 # -------- DB helpers --------
+def _connect():
+    # Prepared statements are reused from the per-connection cache as long as
+    # the SQL text is identical, hence the module-level *_SQL constants below.
+    db = sqlite3.connect(DATABASE, check_same_thread=False, cached_statements=128)
+    db.row_factory = sqlite3.Row
+    # WAL lets leaderboard/export readers run alongside /api/rate writers
+    db.executescript("""
+        PRAGMA journal_mode=WAL;
+        PRAGMA synchronous=NORMAL;
+        PRAGMA temp_store=MEMORY;
+        PRAGMA mmap_size=268435456;
+        PRAGMA cache_size=-20000;
+    """)
+    return db
+
+# Each worker thread opens one connection and keeps it for its lifetime.
+# An in-memory database is private to its connection, so instead every thread
+# shares a single one (StaticPool-style); only the writer thread writes to it.
+_tls = threading.local()
+_memory_db = _connect() if DATABASE == ":memory:" else None
+
 def get_db():
-    db = getattr(g, "_db", None)
+    if _memory_db is not None:
+        return _memory_db
+    db = getattr(_tls, "db", None)
     if db is None:
-        db = g._db = sqlite3.connect(DATABASE, check_same_thread=False)
-        db.row_factory = sqlite3.Row
+        db = _tls.db = _connect()
     return db
 
 def init_db():
@@ -33,25 +68,222 @@ def init_db():
             UNIQUE (entrant_index, device_id)
         )
     """)
+    # Nothing aggregates ratings per request any more (see totals), so the old
+    # covering index would only cost every vote an extra write
+    db.execute("DROP INDEX IF EXISTS idx_ratings_entrant")
+    db.commit()
+    # Running sums per entrant, kept in step with ratings by save_rating()
+    db.execute("BEGIN IMMEDIATE")
+    exists = db.execute("SELECT 1 FROM sqlite_master WHERE type='table' AND name='totals'").fetchone()
+    if not exists:
+        db.execute("""
+            CREATE TABLE totals(
+                entrant_index INTEGER PRIMARY KEY,
+                votes INTEGER NOT NULL DEFAULT 0,
+                sum_taste INTEGER NOT NULL DEFAULT 0,
+                sum_presentation INTEGER NOT NULL DEFAULT 0,
+                sum_easy INTEGER NOT NULL DEFAULT 0
+            )
+        """)
+        # Backfill from ratings recorded before totals existed
+        db.execute("""
+            INSERT INTO totals (entrant_index, votes, sum_taste, sum_presentation, sum_easy)
+            SELECT entrant_index, COUNT(*), SUM(taste), SUM(presentation), SUM(easy)
+            FROM ratings GROUP BY entrant_index
+        """)
     db.commit()
 
+UPSERT_SQL = """
+    INSERT INTO ratings (entrant_index, taste, presentation, easy, judge, device_id)
+    VALUES (?, ?, ?, ?, ?, ?)
+    ON CONFLICT(entrant_index, device_id) DO UPDATE SET
+        taste=excluded.taste,
+        presentation=excluded.presentation,
+        easy=excluded.easy,
+        judge=excluded.judge
+"""
+
+TOTALS_SQL = """
+    INSERT INTO totals (entrant_index, votes, sum_taste, sum_presentation, sum_easy)
+    VALUES (?, ?, ?, ?, ?)
+    ON CONFLICT(entrant_index) DO UPDATE SET
+        votes=votes + excluded.votes,
+        sum_taste=sum_taste + excluded.sum_taste,
+        sum_presentation=sum_presentation + excluded.sum_presentation,
+        sum_easy=sum_easy + excluded.sum_easy
+"""
+
+def save_rating(db, entrant_index, taste, presentation, easy, judge, device_id):
+    """Upsert a rating and apply its delta to totals; caller owns the transaction."""
+    old = db.execute(
+        "SELECT taste, presentation, easy FROM ratings WHERE entrant_index=? AND device_id=?",
+        (entrant_index, device_id),
+    ).fetchone()
+    # Upsert to allow updating previous ratings from same device
+    db.execute(UPSERT_SQL, (entrant_index, taste, presentation, easy, judge, device_id))
+    if old is None:
+        delta = (entrant_index, 1, taste, presentation, easy)
+    else:
+        delta = (entrant_index, 0, taste - old["taste"], presentation - old["presentation"], easy - old["easy"])
+    db.execute(TOTALS_SQL, delta)
+
+# Ratings are written by one background thread per process. Whatever votes
+# queued up while the previous commit ran go into the next transaction together
+# (group commit), so a burst takes the write lock and appends a WAL commit once
+# per group. Writers in different gunicorn workers still contend for the lock
+# and wait on SQLite's busy timeout.
+_write_q = queue.Queue()
+_writer_lock = threading.Lock()
+_writer = None
+
+def _commit_batch(db, batch):
+    try:
+        # IMMEDIATE takes the write lock up front so the old-row reads and writes are atomic
+        db.execute("BEGIN IMMEDIATE")
+        for params, _ in batch:
+            save_rating(db, *params)
+        db.commit()
+    except Exception as exc:
+        db.rollback()
+        if len(batch) > 1:
+            # Retry one by one so a single bad write doesn't fail the others
+            for item in batch:
+                _commit_batch(db, [item])
+        else:
+            batch[0][1].set_exception(exc)
+        return
+    _invalidate_cache(batch)
+    for _, fut in batch:
+        fut.set_result(None)
+
+def _invalidate_cache(batch):
+    """Drop cached responses made stale by a committed batch."""
+    if cache is None:
+        return
+    # Bumping the version orphans every cached leaderboard at once. If Redis is
+    # down the rating is still committed; the stale leaderboard and my-rating
+    # bodies are served for at most CACHE_TTL seconds, since their ETags are
+    # body hashes and every entry is stored with that expiry.
+    try:
+        pipe = cache.pipeline()
+        pipe.incr("ratings:ver")
+        for params, _ in batch:
+            pipe.delete(my_rating_key(params[5], params[0]))
+        pipe.execute()
+    except redis.RedisError as exc:
+        app.logger.warning("Redis invalidation failed: %s", exc)
+
+def _write_loop():
+    while True:
+        batch = [_write_q.get()]
+        # Take only what is already waiting; a lone vote is committed immediately
+        while True:
+            try:
+                batch.append(_write_q.get_nowait())
+            except queue.Empty:
+                break
+        try:
+            _commit_batch(get_db(), batch)
+        except Exception as exc:
+            # Connecting or rolling back failed: fail the waiting callers instead of
+            # killing the thread, and reconnect on the next batch
+            failed = getattr(_tls, "db", None)
+            _tls.db = None
+            if failed is not None:
+                try:
+                    failed.close()
+                except sqlite3.Error:
+                    pass
+            for _, fut in batch:
+                if not fut.done():
+                    fut.set_exception(exc)
+
+def queue_rating(*params):
+    """Hand a rating to the writer thread and block until its batch is committed.
+
+    Raises WriteTimeout if the commit doesn't finish within WRITE_TIMEOUT seconds.
+    """
+    global _writer
+    if _writer is None or not _writer.is_alive():
+        with _writer_lock:
+            if _writer is None or not _writer.is_alive():
+                _writer = threading.Thread(target=_write_loop, name="rating-writer", daemon=True)
+                _writer.start()
+    fut = Future()
+    _write_q.put((params, fut))
+    fut.result(timeout=WRITE_TIMEOUT)
+
 @app.teardown_appcontext
-def close_db(exception):
-    db = getattr(g, "_db", None)
-    if db is not None:
-        db.close()
+def reset_db(exception):
+    # The connection outlives the request; just make sure no transaction leaks into the next one
+    db = getattr(_tls, "db", None)
+    if db is not None and db.in_transaction:
+        db.rollback()
 
 with app.app_context():
     init_db()
 
+# Static pages only depend on constants, so render them once at startup
+with app.test_request_context("/"):
+    INDEX_HTML = render_template("index.html", entrants=ENTRANTS, title="2025 GAME DAY MASTER CHEF COMPETITION CHALLENGE").encode()
+    ADMIN_LOGIN_HTML = render_template("admin_login.html").encode()
+
 # -------- Helpers --------
 def device_id_from_request():
     return request.cookies.get("device_id") or "anon"
 
+def my_rating_key(device_id, entrant_index):
+    return f"my:{device_id}:{entrant_index}"
+
+class Echo:
+    """File-like sink whose write() hands the formatted line straight back."""
+    def write(self, value):
+        return value
+
+def gzip_stream(chunks):
+    # wbits=31 makes zlib emit a gzip container; it buffers internally so
+    # only non-empty output is forwarded
+    co = zlib.compressobj(6, zlib.DEFLATED, 31)
+    for chunk in chunks:
+        out = co.compress(chunk.encode())
+        if out:
+            yield out
+    yield co.flush()
+
+def ojson(obj, status=200):
+    return Response(orjson.dumps(obj), status=status, mimetype="application/json")
+
+# Redis is only a cache: when it is unreachable, log it and serve from SQLite
+def cached_json(key):
+    if cache is None or key is None:
+        return None
+    try:
+        cached = cache.get(key)
+    except redis.RedisError as exc:
+        app.logger.warning("Redis read failed: %s", exc)
+        return None
+    if cached is not None:
+        return Response(cached, mimetype="application/json")
+    return None
+
+def store_json(key, resp):
+    if cache is not None and key is not None:
+        try:
+            cache.set(key, resp.get_data(), ex=CACHE_TTL)
+        except redis.RedisError as exc:
+            app.logger.warning("Redis write failed: %s", exc)
+    return resp
+
+def conditional(resp):
+    # The ETag hashes the body itself, so it can never outlive the data it describes
+    resp.add_etag()
+    resp.headers["Cache-Control"] = f"public, max-age={CACHE_TTL}"
+    return resp.make_conditional(request)
+
 # -------- Routes --------
 @app.route("/")
 def home():
-    resp = make_response(render_template("index.html", entrants=ENTRANTS, title="2025 GAME DAY MASTER CHEF COMPETITION CHALLENGE"))
+    resp = make_response(INDEX_HTML)
     if not request.cookies.get("device_id"):
         resp.set_cookie("device_id", str(uuid.uuid4()), max_age=60*60*24*365, samesite="Lax")
     return resp
@@ -67,31 +299,20 @@ def api_rate():
         easy = int(data.get("easy"))
         judge = (data.get("judge") or "").strip()[:50] or None
     except Exception:
-        return jsonify({"ok": False, "error": "Invalid payload"}), 400
+        return ojson({"ok": False, "error": "Invalid payload"}, 400)
 
     if not (0 <= entrant_index < len(ENTRANTS)):
-        return jsonify({"ok": False, "error": "Invalid entrant"}), 400
-    for v in (taste, presentation, easy):
-        if v < 1 or v > 5:
-            return jsonify({"ok": False, "error": "Scores must be 1–5"}), 400
+        return ojson({"ok": False, "error": "Invalid entrant"}, 400)
+    if not (1 <= taste <= 5 and 1 <= presentation <= 5 and 1 <= easy <= 5):
+        return ojson({"ok": False, "error": "Scores must be 1–5"}, 400)
 
     device_id = device_id_from_request()
-    db = get_db()
-    # Upsert to allow updating previous ratings from same device
-    db.execute(
-        """
-        INSERT INTO ratings (entrant_index, taste, presentation, easy, judge, device_id)
-        VALUES (?, ?, ?, ?, ?, ?)
-        ON CONFLICT(entrant_index, device_id) DO UPDATE SET
-            taste=excluded.taste,
-            presentation=excluded.presentation,
-            easy=excluded.easy,
-            judge=excluded.judge
-        """,
-        (entrant_index, taste, presentation, easy, judge, device_id),
-    )
-    db.commit()
-    return jsonify({"ok": True})
+    try:
+        queue_rating(entrant_index, taste, presentation, easy, judge, device_id)
+    except WriteTimeout:
+        # The vote stays queued and will most likely still be committed
+        return ojson({"ok": False, "error": "Saving is slow right now; your rating may still be recorded. Submitting again is safe."}, 503)
+    return ojson({"ok": True})
 
 # Return this device's rating for an entrant, if any
 @app.route("/api/my-rating")
@@ -99,117 +320,145 @@ def api_my_rating():
     try:
         entrant_index = int(request.args.get("entrant_index", "-1"))
     except Exception:
-        return jsonify({"ok": False, "error": "Bad entrant index"}), 400
+        return ojson({"ok": False, "error": "Bad entrant index"}, 400)
     if not (0 <= entrant_index < len(ENTRANTS)):
-        return jsonify({"ok": True, "rating": None})
+        return ojson({"ok": True, "rating": None})
 
     device_id = device_id_from_request()
+    key = my_rating_key(device_id, entrant_index)
+    cached = cached_json(key)
+    if cached is not None:
+        return cached
     db = get_db()
     row = db.execute(
         "SELECT taste, presentation, easy, judge FROM ratings WHERE entrant_index=? AND device_id=?",
         (entrant_index, device_id),
     ).fetchone()
     if not row:
-        return jsonify({"ok": True, "rating": None})
-    return jsonify({"ok": True, "rating": dict(row)})
+        return store_json(key, ojson({"ok": True, "rating": None}))
+    rating = {"taste": row[0], "presentation": row[1], "easy": row[2], "judge": row[3]}
+    return store_json(key, ojson({"ok": True, "rating": rating}))
 
 # Public leaderboard JSON
 @app.route("/api/leaderboard")
 def api_leaderboard():
+    key = None
+    if cache is not None:
+        try:
+            key = "lb:%d" % int(cache.get("ratings:ver") or 0)
+        except redis.RedisError as exc:
+            app.logger.warning("Redis read failed: %s", exc)
+    # The version only keys the Redis body cache; it is never trusted for 304s
+    cached = cached_json(key)
+    if cached is not None:
+        return conditional(cached)
     db = get_db()
+    # votes > 0 guarantees non-null averages, so rounding can happen in SQL
     rows = db.execute("""
         SELECT entrant_index,
-               COUNT(*) AS votes,
-               AVG(taste) AS avg_taste,
-               AVG(presentation) AS avg_presentation,
-               AVG(easy) AS avg_easy,
-               AVG(taste + presentation + easy) AS avg_total
-        FROM ratings
-        GROUP BY entrant_index
-        ORDER BY avg_total DESC
+               votes,
+               ROUND(1.0 * sum_taste / votes, 2) AS avg_taste,
+               ROUND(1.0 * sum_presentation / votes, 2) AS avg_presentation,
+               ROUND(1.0 * sum_easy / votes, 2) AS avg_easy,
+               ROUND(1.0 * (sum_taste + sum_presentation + sum_easy) / votes, 2) AS avg_total
+        FROM totals
+        WHERE votes > 0
+        ORDER BY 1.0 * (sum_taste + sum_presentation + sum_easy) / votes DESC
     """).fetchall()
 
-    out = []
-    for r in rows:
-        out.append({
-            "name": ENTRANTS[r["entrant_index"]],
-            "votes": r["votes"],
-            "avg_taste": round(r["avg_taste"], 2) if r["avg_taste"] is not None else 0,
-            "avg_presentation": round(r["avg_presentation"], 2) if r["avg_presentation"] is not None else 0,
-            "avg_easy": round(r["avg_easy"], 2) if r["avg_easy"] is not None else 0,
-            "avg_total": round(r["avg_total"], 2) if r["avg_total"] is not None else 0
-        })
-    return jsonify(out)
+    entrants = ENTRANTS  # local alias for the per-row lookups below
+    out = [{
+        "name": entrants[r[0]],
+        "votes": r[1],
+        "avg_taste": r[2],
+        "avg_presentation": r[3],
+        "avg_easy": r[4],
+        "avg_total": r[5],
+    } for r in rows]
+    return conditional(store_json(key, ojson(out)))
 
 # CSV export
 @app.route("/export.csv")
 def export_csv():
-    db = get_db()
-    rows = db.execute("""
-        SELECT id, entrant_index, taste, presentation, easy, judge, device_id, created_at
-        FROM ratings
-        ORDER BY created_at ASC
-    """).fetchall()
-
     def generate():
-        header = ["id","entrant_name","taste","presentation","easy","judge","device_id","created_at"]
-        yield ",".join(header) + "\n"
-        for r in rows:
-            name = ENTRANTS[r["entrant_index"]]
-            line = [
-                str(r["id"]),
-                '"' + name.replace('"','""') + '"',
-                str(r["taste"]),
-                str(r["presentation"]),
-                str(r["easy"]),
-                '"' + (r["judge"] or "").replace('"','""') + '"',
-                '"' + (r["device_id"] or "") + '"',
-                str(r["created_at"])
-            ]
-            yield ",".join(line) + "\n"
-
-    return Response(generate(), mimetype="text/csv")
+        entrants = ENTRANTS
+        # Rows are pulled lazily from the cursor as the response streams
+        cur = get_db().execute("""
+            SELECT id, entrant_index, taste, presentation, easy, judge, device_id, created_at
+            FROM ratings
+            ORDER BY created_at ASC
+        """)
+        writer = csv.writer(Echo(), lineterminator="\n")
+        yield writer.writerow(["id","entrant_name","taste","presentation","easy","judge","device_id","created_at"])
+        for r in cur:
+            yield writer.writerow([
+                r["id"],
+                entrants[r["entrant_index"]],
+                r["taste"],
+                r["presentation"],
+                r["easy"],
+                r["judge"] or "",
+                r["device_id"] or "",
+                r["created_at"],
+            ])
+
+    if request.accept_encodings["gzip"]:
+        resp = Response(stream_with_context(gzip_stream(generate())), mimetype="text/csv")
+        resp.headers["Content-Encoding"] = "gzip"
+    else:
+        resp = Response(stream_with_context(generate()), mimetype="text/csv")
+    resp.vary.add("Accept-Encoding")
+    return resp
 
 # -------- Admin: detailed results with simple password gate --------
-ADMIN_PASSWORD = os.environ.get("ADMIN_PASSWORD", "MASTERCHEF2025")
+# Only the digest is kept around; compared in constant time on login
+ADMIN_PASSWORD_HASH = hashlib.sha256(os.environ.get("ADMIN_PASSWORD", "MASTERCHEF2025").encode()).digest()
 
 @app.route("/admin", methods=["GET", "POST"])
 def admin():
     if request.method == "POST":
         pw = (request.form.get("password") or "").strip()
-        if pw == ADMIN_PASSWORD:
+        if hmac.compare_digest(hashlib.sha256(pw.encode()).digest(), ADMIN_PASSWORD_HASH):
             session["is_admin"] = True
             return redirect(url_for("admin"))
         return render_template("admin_login.html", error="Incorrect password")
     if not session.get("is_admin"):
-        return render_template("admin_login.html")
+        return ADMIN_LOGIN_HTML
     # Show detailed table
+    entrants = ENTRANTS
     db = get_db()
     rows = db.execute("""
-        SELECT r.id, r.entrant_index, r.taste, r.presentation, r.easy, r.judge, r.device_id, r.created_at
+        SELECT r.id, r.entrant_index, r.taste, r.presentation, r.easy,
+               r.taste + r.presentation + r.easy AS total,
+               r.judge, r.device_id, r.created_at
         FROM ratings r
         ORDER BY r.entrant_index ASC, r.created_at ASC
-    """).fetchall()
-    detailed = [{
-        "id": r["id"],
-        "entrant": ENTRANTS[r["entrant_index"]],
-        "taste": r["taste"],
-        "presentation": r["presentation"],
-        "easy": r["easy"],
-        "total": r["taste"] + r["presentation"] + r["easy"],
-        "judge": r["judge"] or "",
-        "device_id": r["device_id"] or "",
-        "created_at": r["created_at"],
-    } for r in rows]
+    """)
+    # Generator over the cursor; the template consumes it row by row.
+    # Rows unpack positionally in the SELECT's column order.
+    def rows_iter():
+        for i, ei, t, p, e, tot, j, d, c in rows:
+            yield {
+                "id": i,
+                "entrant": entrants[ei],
+                "taste": t,
+                "presentation": p,
+                "easy": e,
+                "total": tot,
+                "judge": j or "",
+                "device_id": d or "",
+                "created_at": c,
+            }
+    detailed = rows_iter()
     # Also compute leaderboard snapshot
-    lb = get_db().execute("""
+    lb = db.execute("""
         SELECT entrant_index,
-               COUNT(*) AS votes,
-               AVG(taste + presentation + easy) AS avg_total
-        FROM ratings GROUP BY entrant_index
-        ORDER BY avg_total DESC
+               votes,
+               ROUND(1.0 * (sum_taste + sum_presentation + sum_easy) / votes, 2) AS avg_total
+        FROM totals WHERE votes > 0
+        ORDER BY 1.0 * (sum_taste + sum_presentation + sum_easy) / votes DESC
     """).fetchall()
-    lb_data = [{"name": ENTRANTS[r["entrant_index"]], "votes": r["votes"], "avg_total": round(r["avg_total"] or 0, 2)} for r in lb]
+    lb_data = [{"name": entrants[r[0]], "votes": r[1], "avg_total": r[2]} for r in lb]
     return render_template("admin_results.html", detailed=detailed, leaderboard=lb_data, title="Admin Detailed Results")
 
 @app.route("/admin/logout")
@@ -0,0 +1,17 @@
+import os, tempfile
+
+import pytest
+
+# A file database, so each test can point the thread-local connections at its own copy
+os.environ.setdefault("DATABASE_URL", os.path.join(tempfile.mkdtemp(), "ratings.db"))
+import app  # noqa: E402
+
+
+@pytest.fixture
+def db(tmp_path, monkeypatch):
+    monkeypatch.setattr(app, "DATABASE", str(tmp_path / "ratings.db"))
+    monkeypatch.setattr(app._tls, "db", None)
+    app.init_db()
+    conn = app.get_db()
+    yield conn
+    conn.close()
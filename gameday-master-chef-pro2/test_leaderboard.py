@@ -0,0 +1,31 @@
+import app
+
+
+def vote(db, *params):
+    db.execute("BEGIN IMMEDIATE")
+    app.save_rating(db, *params)
+    db.commit()
+
+
+def test_unchanged_leaderboard_revalidates_with_304(db):
+    client = app.app.test_client()
+    vote(db, 0, 5, 4, 3, None, "dev1")
+    first = client.get("/api/leaderboard")
+    etag = first.headers["ETag"]
+    assert first.status_code == 200
+
+    again = client.get("/api/leaderboard", headers={"If-None-Match": etag})
+    assert again.status_code == 304
+    assert again.get_data() == b""
+
+
+def test_new_vote_changes_etag(db):
+    client = app.app.test_client()
+    vote(db, 0, 5, 4, 3, None, "dev1")
+    etag = client.get("/api/leaderboard").headers["ETag"]
+
+    vote(db, 1, 2, 2, 2, None, "dev1")
+    resp = client.get("/api/leaderboard", headers={"If-None-Match": etag})
+    assert resp.status_code == 200
+    assert resp.headers["ETag"] != etag
+    assert [row["name"] for row in resp.get_json()] == ["Javier", "Lindsay"]
@@ -0,0 +1,72 @@
+import sqlite3
+from concurrent.futures import Future
+
+import pytest
+
+import app
+
+
+def totals(db):
+    rows = db.execute("SELECT entrant_index, votes, sum_taste, sum_presentation, sum_easy FROM totals")
+    return {r[0]: tuple(r[1:]) for r in rows}
+
+
+def commit(db, *items):
+    batch = [(params, Future()) for params in items]
+    app._commit_batch(db, batch)
+    return [fut for _, fut in batch]
+
+
+def test_first_vote_adds_to_totals(db):
+    commit(db, (0, 5, 4, 3, None, "dev1"))
+    assert totals(db) == {0: (1, 5, 4, 3)}
+
+
+def test_revote_applies_delta_without_extra_vote(db):
+    commit(db, (0, 5, 4, 3, None, "dev1"))
+    commit(db, (0, 2, 2, 5, "Judy", "dev1"))
+    commit(db, (0, 1, 1, 1, None, "dev2"))
+    assert totals(db) == {0: (2, 3, 3, 6)}
+
+
+def test_failed_item_in_batch_leaves_totals_consistent(db):
+    good1, bad, good2 = commit(
+        db,
+        (0, 5, 5, 5, None, "dev1"),
+        (0, 9, 5, 5, None, "dev2"),  # violates the CHECK constraint
+        (1, 3, 3, 3, None, "dev1"),
+    )
+    assert good1.result() is None and good2.result() is None
+    with pytest.raises(sqlite3.IntegrityError):
+        bad.result()
+    assert totals(db) == {0: (1, 5, 5, 5), 1: (1, 3, 3, 3)}
+    assert db.execute("SELECT COUNT(*) FROM ratings").fetchone()[0] == 2
+
+
+def test_backfill_from_existing_ratings(tmp_path, monkeypatch):
+    path = str(tmp_path / "old.db")
+    old = sqlite3.connect(path)
+    old.execute("""
+        CREATE TABLE ratings(
+            id INTEGER PRIMARY KEY AUTOINCREMENT,
+            entrant_index INTEGER NOT NULL,
+            taste INTEGER NOT NULL, presentation INTEGER NOT NULL, easy INTEGER NOT NULL,
+            judge TEXT, device_id TEXT,
+            created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+            UNIQUE (entrant_index, device_id)
+        )
+    """)
+    old.executemany(
+        "INSERT INTO ratings (entrant_index, taste, presentation, easy, device_id) VALUES (?, ?, ?, ?, ?)",
+        [(0, 5, 4, 3, "a"), (0, 1, 2, 3, "b"), (2, 4, 4, 4, "a")],
+    )
+    old.commit()
+    old.close()
+
+    monkeypatch.setattr(app, "DATABASE", path)
+    monkeypatch.setattr(app._tls, "db", None)
+    app.init_db()
+    app.init_db()  # a restart must not count the ratings twice
+    db = app.get_db()
+    assert totals(db) == {0: (2, 6, 6, 6), 2: (1, 4, 4, 4)}
+    db.close()